@@ -1,19 +1,82 @@
 import copy
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, CancelledError
 from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Tuple
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+from threading import get_ident, Lock
+from typing import List, Dict, Optional, Tuple, Iterator, Any, Set
 
-import networkx as nx
 import numpy as np
+import tensorflow as tf
 from drbcython.graph import py_GSet
 from drbcython.utils import py_Utils
 from tensorflow.keras.utils import Sequence
 from tensorflow.keras.callbacks import Callback
 from tqdm import tqdm
 
+from drbc.graph_gen import generate_graph, gen_network, pin_to_cpus
 from drbc.util import ThreadWithReturnValue
 from drbcython import utils, graph, PrepareBatchGraph
 
 
+class GraphPool:
+    """
+    Long-lived pool of processes generating graphs, shared by the generators (and their copies)
+    The workers are started from a forkserver instead of being forked from the (multithreaded) training process
+    => they never inherit a lock held by another thread at the time of the fork
+    (e.g. numpy's global RandomState lock held by the tf.data thread while sampling the pair ids)
+    """
+    def __init__(self, workers: Optional[int] = None, cpus: Optional[Set[int]] = None):
+        self.workers = workers or (len(cpus) if cpus else os.cpu_count())
+        # The workers only need the tensorflow-free `graph_gen` => import it once in the server instead of in every worker
+        context = get_context('forkserver')
+        context.set_forkserver_preload(['drbc.graph_gen'])
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                            initializer=pin_to_cpus, initargs=(cpus,))
+        self.closed = False
+        self.futures = set()
+        self.lock = Lock()
+
+    def map(self, fn, items) -> Iterator:
+        """ Executor.map which keeps only a few tasks in flight and stops once the pool is closed """
+        pending = deque()
+        try:
+            for item in items:
+                if self.closed:
+                    return
+                with self.lock:
+                    pending.append(self.executor.submit(fn, item))
+                    self.futures.add(pending[-1])
+                if len(pending) >= 2 * self.workers:
+                    yield self.pop_result(pending)
+            while pending and not self.closed:
+                yield self.pop_result(pending)
+        except (CancelledError, RuntimeError):  # RuntimeError => submitted after the executor was shut down
+            if not self.closed:
+                raise
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def pop_result(self, pending: deque) -> Any:
+        future = pending.popleft()
+        with self.lock:
+            self.futures.discard(future)
+        return future.result()
+
+    def close(self):
+        """ Cancel the tasks which have not started yet (only the ones already running are finished) """
+        with self.lock:
+            self.closed = True
+            for future in self.futures:
+                future.cancel()
+            self.futures.clear()
+        self.executor.shutdown(wait=False)
+
+
 @dataclass
 class DataGenerator(Sequence):
     utils: py_Utils = field(default_factory=lambda: utils.py_Utils())
@@ -33,40 +96,66 @@ class DataGenerator(Sequence):
     random_samples: bool = True
     log_betweenness: bool = True
     compute_betweenness: bool = True
+    cache_dir: Optional[str] = None
+    cache_size: int = 0
+    graph_workers: Optional[int] = None
+    worker_cpus: Optional[Set[int]] = None
+    pool: Optional[GraphPool] = None
     neighbor_aggregation_ids: Dict[str, int] = field(default_factory=lambda: {'sum': 0, 'mean': 1, 'gcn': 2})
 
     def __len__(self) -> int:
         return self.nb_batches
 
     def get_batch(self, graphs, ids: List[int]):
-        label = []
-        for i in ids:
-            label += self.betweenness[i]
-        label = np.array(label)
+        label = np.concatenate([self.betweenness[i] for i in ids])
 
         aggregator_id = self.neighbor_aggregation_ids[self.node_neighbors_aggregation]
         batch_graph = PrepareBatchGraph.py_PrepareBatchGraph(aggregator_id)
         batch_graph.SetupBatchGraph(graphs)
-        assert (len(batch_graph.pair_ids_src) == len(batch_graph.pair_ids_tgt))
+        # Each access to the pair ids samples new random pairs => fetch them only once
+        pair_ids_src, pair_ids_tgt = batch_graph.pair_ids_src, batch_graph.pair_ids_tgt
+        assert (len(pair_ids_src) == len(pair_ids_tgt))
 
         batch_size = len(label)
         x = [
-            np.array(batch_graph.node_feat),
-            np.array(batch_graph.aux_feat),
+            np.array(batch_graph.node_feat, dtype=np.float32),
+            np.array(batch_graph.aux_feat, dtype=np.float32),
             batch_graph.n2nsum_param
         ]
         y = np.concatenate([
             np.reshape(label, (batch_size, 1)),
-            np.reshape(batch_graph.pair_ids_src, (batch_size, -1)),
-            np.reshape(batch_graph.pair_ids_tgt, (batch_size, -1)),
+            np.reshape(pair_ids_src, (batch_size, -1)),
+            np.reshape(pair_ids_tgt, (batch_size, -1)),
         ], axis=-1)
-        return (x, y, batch_graph.idx_map_list[0]) if self.include_idx_map else (x, y)
+        return (x, y, batch_graph.idx_map_list) if self.include_idx_map else (x, y)
 
     def __getitem__(self, index: int):
         if self.random_samples:
             g_list, id_list = self.graphs.Sample_Batch(self.graphs_per_batch)
             return self.get_batch(graphs=g_list, ids=id_list)
-        return self.get_batch(graphs=[self.graphs.Get(index)], ids=[index])
+        id_list = list(range(index * self.graphs_per_batch, min((index + 1) * self.graphs_per_batch, self.count)))
+        return self.get_batch(graphs=[self.graphs.Get(i) for i in id_list], ids=id_list)
+
+    @staticmethod
+    def output_signature():
+        """ ((node_features, aux_features, n2n_sum), [betweenness | src_ids | tgt_ids]) of a single batch """
+        return (
+            (
+                tf.TensorSpec(shape=(None, 3), dtype=tf.float32, name='node_features'),
+                tf.TensorSpec(shape=(None, 4), dtype=tf.float32, name='aux_features'),
+                tf.SparseTensorSpec(shape=(None, None), dtype=tf.float32),
+            ),
+            tf.TensorSpec(shape=(None, None), dtype=tf.float32, name='labels'),
+        )
+
+    def as_dataset(self) -> tf.data.Dataset:
+        """ tf.data pipeline which prepares the upcoming batches in the background """
+        assert not self.include_idx_map
+        dataset = tf.data.Dataset.from_generator(lambda: ((tuple(x), y) for x, y in self),
+                                                 output_signature=self.output_signature())
+        # Known cardinality => model.fit knows the epoch length and recreates the iterator on every epoch
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(len(self)))
+        return dataset.prefetch(tf.data.AUTOTUNE)
 
     def __copy__(self) -> 'DataGenerator':
         """ Omit utils and graphs as they are cython objects and do not support copying """
@@ -75,30 +164,10 @@ class DataGenerator(Sequence):
         res.clear()
         return res
 
-    @staticmethod
-    def gen_network(g):  # networkx2four
-        edges = g.edges()
-        if len(edges) > 0:
-            a, b = zip(*edges)
-            a = np.array(a)
-            b = np.array(b)
-        else:
-            a = np.array([0])
-            b = np.array([0])
-        return graph.py_Graph(len(g.nodes()), len(edges), a, b)
-
-    def gen_graph(self):
-        cur_n = np.random.randint(self.min_nodes, self.max_nodes)
-        if self.graph_type == 'erdos_renyi':        return nx.erdos_renyi_graph(n=cur_n, p=0.15)
-        elif self.graph_type == 'small-world':      return nx.connected_watts_strogatz_graph(n=cur_n, k=8, p=0.1)
-        elif self.graph_type == 'barabasi_albert':  return nx.barabasi_albert_graph(n=cur_n, m=4)
-        elif self.graph_type == 'powerlaw':         return nx.powerlaw_cluster_graph(n=cur_n, m=4, p=0.05)
-        raise ValueError(f'{self.graph_type} graph type is not supported yet')
-
     def add_graph(self, g):
         t = self.count
         self.count += 1
-        net = self.gen_network(g)
+        net = gen_network(g)
         self.graphs.InsertGraph(t, net)
 
         if self.compute_betweenness:
@@ -106,11 +175,56 @@ class DataGenerator(Sequence):
             bc_log = self.utils.bc_log
             self.betweenness.append(bc_log if self.log_betweenness else bc)
 
+    def insert_graph(self, num_nodes: int, edges: np.ndarray, betweenness: np.ndarray, betweenness_log: np.ndarray):
+        t = self.count
+        self.count += 1
+        net = graph.py_Graph(int(num_nodes), len(edges), edges[:, 0], edges[:, 1])
+        self.graphs.InsertGraph(t, net)
+
+        if self.compute_betweenness:
+            self.betweenness.append((betweenness_log if self.log_betweenness else betweenness).tolist())
+
+    def create_pool(self) -> Optional[GraphPool]:
+        """ Pool of `graph_workers` processes pinned to `worker_cpus` (None => generate the graphs sequentially) """
+        return None if self.graph_workers == 1 else GraphPool(workers=self.graph_workers, cpus=self.worker_cpus)
+
+    def generate(self, nb_graphs: int) -> Iterator[Dict[str, Any]]:
+        """ Generate `nb_graphs` graphs in parallel on the worker `pool` (sequentially if there is no pool) """
+        generate = partial(generate_graph, self.graph_type, self.min_nodes, self.max_nodes, self.compute_betweenness)
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=nb_graphs).tolist()
+        if self.pool is None:
+            yield from map(generate, seeds)
+            return
+        yield from self.pool.map(generate, seeds)
+
+    def cached_graph_path(self, gid: int) -> Path:
+        return Path(self.cache_dir) / f'{self.tag.lower()}-{self.graph_type}-{self.min_nodes}-{self.max_nodes}' / f'{gid}.npz'
+
+    @staticmethod
+    def save_graph(path: Path, g: Dict[str, Any]):
+        # Write to a temporary file first so that concurrent readers never see a partially written graph
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.stem}.{os.getpid()}.{get_ident()}.npz')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **g)
+        os.replace(tmp, path)
+
     def gen_new_graphs(self):
         self.clear()
-        for _ in tqdm(range(self.nb_graphs), desc=f'{self.tag}: generating new graphs...'):
-            g = self.gen_graph()
-            self.add_graph(g)
+        if self.cache_dir is None:
+            for g in tqdm(self.generate(self.nb_graphs), total=self.nb_graphs, desc=f'{self.tag}: generating new graphs...'):
+                self.insert_graph(**g)
+            return
+
+        # Generate the pool of `cache_size` graphs only once and then sample a new subset of them on every call
+        missing = [gid for gid in range(self.cache_size) if not self.cached_graph_path(gid).exists()]
+        for gid, g in tqdm(zip(missing, self.generate(len(missing))), total=len(missing), desc=f'{self.tag}: caching graphs...'):
+            self.save_graph(self.cached_graph_path(gid), g)
+        if self.pool is not None and self.pool.closed:
+            return
+        gids = np.random.choice(self.cache_size, size=self.nb_graphs, replace=self.cache_size < self.nb_graphs)
+        for gid in tqdm(gids, desc=f'{self.tag}: loading cached graphs...'):
+            self.insert_graph(**np.load(self.cached_graph_path(gid)))
 
     def clear(self):
         self.count = 0
@@ -131,9 +245,10 @@ class DataMonitor(Callback):
     """
     Provide new data when it is used too much
     Generate new graphs once per every `update_frequency` epochs
-    Uses multithreading to genearte new data on a separate thread
-    (does not use mutiprocessing as it would require to pickle/unpickle cython `utils` and `graphs` which have
-     a cinit => require custom __reduce__ of all types in this project)
+    Uses multithreading to genearte new data on a separate thread while the current epochs are being trained
+    (the generators themselves can't be sent to other processes as it would require to pickle/unpickle cython
+     `utils` and `graphs` which have a cinit => the generators share a `GraphPool` of `graph_workers` processes
+     which generate individual graphs and only send back picklable edges and betweenness values)
     """
     train_generator: DataGenerator
     valid_generator: Optional[DataGenerator]
@@ -141,29 +256,48 @@ class DataMonitor(Callback):
 
     prefetch: int = 1
     processes: List[ThreadWithReturnValue] = field(default_factory=lambda: list())
+    pool: Optional[GraphPool] = None
 
     def on_train_begin(self, logs=None):
         assert self.prefetch >= 1
+        # A single pool shared between all the generations. Its processes are only started on the first submit,
+        # i.e. from the generation thread, which is fine as they are forked from the forkserver, not from this process
+        self.pool = self.train_generator.create_pool()
+        self.train_generator.pool = self.pool
+        if self.valid_generator:
+            self.valid_generator.pool = self.pool
         for i in range(self.prefetch):
-            t = ThreadWithReturnValue(target=gen_new, daemon=True,
-                                      args=(copy.copy(self.train_generator), copy.copy(self.valid_generator)))
-            t.start()
-            self.processes.append(t)
+            self.start_generation()
+        # model.fit creates the data iterator of each epoch before `on_epoch_begin` is called
+        # => the first graphs are needed right away and later ones are swapped in at the end of an epoch
+        self.swap_data()
         return super().on_train_begin(logs)
 
-    def on_epoch_begin(self, epoch, logs=None):
-        if epoch % self.update_frequency != 0:
-            return super().on_epoch_begin(epoch, logs)
+    def on_epoch_end(self, epoch, logs=None):
+        # No need for new graphs (nor for starting another generation) once the training is over
+        training_ends = self.model.stop_training or epoch + 1 >= self.params['epochs']
+        if (epoch + 1) % self.update_frequency == 0 and not training_ends:
+            self.swap_data()
+        return super().on_epoch_end(epoch, logs)
+
+    def on_train_end(self, logs=None):
+        # Stop the generation still running in the background => the process exits right after the training
+        self.processes.clear()
+        if self.pool is not None:
+            self.pool.close()
+        return super().on_train_end(logs)
 
+    def start_generation(self):
+        t = ThreadWithReturnValue(target=gen_new, daemon=True,
+                                  args=(copy.copy(self.train_generator), copy.copy(self.valid_generator)))
+        t.start()
+        self.processes.append(t)
+
+    def swap_data(self):
         front = self.processes.pop(0)
         train, valid = front.join()
         self.train_generator.clear()
         self.valid_generator.clear()
         self.train_generator.__dict__ = train.__dict__
         self.valid_generator.__dict__ = valid.__dict__
-
-        t = ThreadWithReturnValue(target=gen_new, daemon=True,
-                                  args=(copy.copy(self.train_generator), copy.copy(self.valid_generator)))
-        t.start()
-        self.processes.append(t)
-        return super().on_epoch_begin(epoch, logs)
+        self.start_generation()
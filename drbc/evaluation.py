@@ -1,7 +1,9 @@
 import numpy as np
+import tensorflow as tf
 from sklearn.metrics import mean_squared_error, max_error
 from tensorflow.keras.callbacks import Callback
 
+from drbc.data import DataGenerator
 from drbcython import metrics
 
 
@@ -12,6 +14,20 @@ class EvaluateCallback(Callback):
         self.prepend_str = prepend_str
         self.metrics = metrics.py_Metrics()
         self._supports_tf_logs = True
+        self.score = None
+
+    def set_model(self, model):
+        super().set_model(model)
+        node_inputs, _ = DataGenerator.output_signature()
+
+        @tf.function(input_signature=[node_inputs, tf.TensorSpec(shape=(None,), dtype=tf.int32, name='idx_map')])
+        def score(x, idx_map):
+            """ Predict the betweenness of all the nodes (10^-pred and masking are done in the same graph) """
+            pred = tf.reshape(self.model(x, training=False), (-1,))
+            scored = tf.exp(tf.where(tf.abs(pred) < 10, -pred, 10.) * tf.math.log(10.))
+            return tf.where(idx_map >= 0, scored, tf.zeros_like(scored))
+
+        self.score = score
 
     def evaluate(self):
         epoch_logs = {
@@ -22,19 +38,20 @@ class EvaluateCallback(Callback):
             f'{self.prepend_str}mse': [],
             f'{self.prepend_str}max_error': [],
         }
-        for gid, (x, y, idx_map) in enumerate(self.data_generator):
-            result = self.model.predict_on_batch(x=x).flatten()
-            betw_predict = [np.power(10, -pred_betweenness if np.abs(pred_betweenness) < 10 else 10)
-                            if idx_map[i] >= 0 else 0
-                            for i, pred_betweenness in enumerate(result)]
-
-            betw_label = self.data_generator.betweenness[gid]
-            epoch_logs[f'{self.prepend_str}top0_01'].append(self.metrics.RankTopK(betw_label, betw_predict, 0.01))
-            epoch_logs[f'{self.prepend_str}top0_05'].append(self.metrics.RankTopK(betw_label, betw_predict, 0.05))
-            epoch_logs[f'{self.prepend_str}top0_1'].append(self.metrics.RankTopK(betw_label, betw_predict, 0.1))
-            epoch_logs[f'{self.prepend_str}kendal'].append(self.metrics.RankKendal(betw_label, betw_predict))
-            epoch_logs[f'{self.prepend_str}mse'].append(mean_squared_error(betw_label, betw_predict))
-            epoch_logs[f'{self.prepend_str}max_error'].append(max_error(betw_label, betw_predict))
+        # Several graphs are evaluated in a single forward pass => split the predictions back per graph
+        gid = 0
+        for x, y, idx_maps in self.data_generator:
+            idx_map = np.concatenate(idx_maps).astype(np.int32)
+            predictions = self.score(tuple(x), idx_map).numpy()
+            for betw_predict in np.split(predictions, np.cumsum([len(m) for m in idx_maps])[:-1]):
+                betw_label = self.data_generator.betweenness[gid]
+                gid += 1
+                epoch_logs[f'{self.prepend_str}top0_01'].append(self.metrics.RankTopK(betw_label, betw_predict, 0.01))
+                epoch_logs[f'{self.prepend_str}top0_05'].append(self.metrics.RankTopK(betw_label, betw_predict, 0.05))
+                epoch_logs[f'{self.prepend_str}top0_1'].append(self.metrics.RankTopK(betw_label, betw_predict, 0.1))
+                epoch_logs[f'{self.prepend_str}kendal'].append(self.metrics.RankKendal(betw_label, betw_predict))
+                epoch_logs[f'{self.prepend_str}mse'].append(mean_squared_error(betw_label, betw_predict))
+                epoch_logs[f'{self.prepend_str}max_error'].append(max_error(betw_label, betw_predict))
         return {k: np.mean(val) for k, val in epoch_logs.items()}
 
     def on_epoch_end(self, epoch, logs=None):
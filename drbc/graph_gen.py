@@ -0,0 +1,57 @@
+"""
+Graph generation which runs in the worker processes of the `GraphPool`
+Deliberately does not import tensorflow => starting a worker only imports networkx, numpy and the cython graph utils
+"""
+import os
+from typing import Dict, Any, Optional, Set
+
+import networkx as nx
+import numpy as np
+
+from drbcython import utils, graph
+
+
+def pin_to_cpus(cpus: Optional[Set[int]]):
+    """ Restrict the current process to the given CPUs (no-op if not provided or not supported by the platform) """
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def gen_network(g):  # networkx2four
+    edges = g.edges()
+    if len(edges) > 0:
+        a, b = zip(*edges)
+        a = np.array(a)
+        b = np.array(b)
+    else:
+        a = np.array([0])
+        b = np.array([0])
+    return graph.py_Graph(len(g.nodes()), len(edges), a, b)
+
+
+def gen_graph(graph_type: str, min_nodes: int, max_nodes: int, seed: Optional[int] = None):
+    """ Uses its own random state => never touches the global RNGs which are shared with the training process """
+    rng = np.random.RandomState(seed)
+    cur_n = rng.randint(min_nodes, max_nodes)
+    if graph_type == 'erdos_renyi':         return nx.erdos_renyi_graph(n=cur_n, p=0.15, seed=rng)
+    elif graph_type == 'small-world':       return nx.connected_watts_strogatz_graph(n=cur_n, k=8, p=0.1, seed=rng)
+    elif graph_type == 'barabasi_albert':   return nx.barabasi_albert_graph(n=cur_n, m=4, seed=rng)
+    elif graph_type == 'powerlaw':          return nx.powerlaw_cluster_graph(n=cur_n, m=4, p=0.05, seed=rng)
+    raise ValueError(f'{graph_type} graph type is not supported yet')
+
+
+def generate_graph(graph_type: str, min_nodes: int, max_nodes: int, compute_betweenness: bool, seed: int) -> Dict[str, Any]:
+    """
+    Generate a single graph along with its betweenness
+    Runs in a worker process => returns only picklable numpy arrays instead of the cython objects
+    """
+    g = gen_graph(graph_type, min_nodes, max_nodes, seed=seed)
+    net = gen_network(g)
+    bc_utils = utils.py_Utils()
+    bc = bc_utils.Betweenness(net) if compute_betweenness else []
+    return {
+        'num_nodes': len(g.nodes()),
+        'edges': np.array(g.edges(), dtype=np.int32).reshape(-1, 2),
+        'betweenness': np.array(bc),
+        'betweenness_log': np.array(bc_utils.bc_log if compute_betweenness else []),
+    }
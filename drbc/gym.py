@@ -1,23 +1,25 @@
-import copy
+import math
+import os
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 import fire
-import pandas as pd
+import tensorflow as tf
 from aim import Session
 from aim.tensorflow import AimCallback
-from tensorflow.keras.callbacks import CallbackList, ModelCheckpoint, EarlyStopping, TensorBoard, ReduceLROnPlateau
+from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, TensorBoard, ReduceLROnPlateau
 from tensorflow.python.keras.models import Model
 
 from drbc.data import DataGenerator, DataMonitor
 from drbc.evaluation import EvaluateCallback
 from drbc.loss import pairwise_ranking_crossentropy_loss
 from drbc.models import drbc_model
+from drbc.util import HistoryLogger
 
 
 def parse_params(params: Dict):
-    res = copy.copy(params)
+    res = dict(params)
     res.pop('self', None)
     res.pop('np', None)
     return res
@@ -26,23 +28,37 @@ def parse_params(params: Dict):
 class Gym:
     train_generator: DataGenerator
     valid_generator: DataGenerator
+    train_dataset: tf.data.Dataset
     model: Model
 
-    def __init__(self, experiment: str = 'vanilla_drbc'):
+    def __init__(self, experiment: str = 'vanilla_drbc', split_cpus: bool = True):
         """
         Gym is the object which keeps track of the model and the data on which it is trained
         It handles the logging, experiment tracking, data generation, initialization, and training
         @param experiment: description of the experiment
+        @param split_cpus: give half of the CPUs to the TF thread pools and the other half to the graph generation
+               workers so that they don't compete with each other (has to be set before TF is initialized)
         """
+        self.generation_cpus = None
+        if split_cpus:
+            cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+            nb_tf_cpus = max(1, len(cpus) // 2)
+            tf.config.threading.set_intra_op_parallelism_threads(nb_tf_cpus)
+            tf.config.threading.set_inter_op_parallelism_threads(2)
+            self.generation_cpus = set(cpus[nb_tf_cpus:]) or None
+
         self.experiment_path = Path('experiments') / datetime.now().replace(microsecond=0).isoformat()
         self.model_save_path = self.experiment_path / 'models/'
         self.log_dir = self.experiment_path / 'logs/'
         self.model_save_path.mkdir(parents=True, exist_ok=True)
         self.log_dir.mkdir(parents=True, exist_ok=True)
 
+        # Point `latest` to the new experiment atomically (other processes might be reading/updating it concurrently)
         latest = Path('experiments/latest/').absolute()
-        latest.unlink(missing_ok=True)
-        latest.symlink_to(self.experiment_path.absolute(), target_is_directory=True)
+        tmp = latest.with_name(f'.latest.{os.getpid()}')
+        tmp.unlink(missing_ok=True)
+        tmp.symlink_to(self.experiment_path.absolute(), target_is_directory=True)
+        os.replace(tmp, latest)
 
         print(f'Logging experiments at: `{self.experiment_path.absolute()}`')
         self.aim_session = Session(experiment=experiment)
@@ -50,7 +66,9 @@ class Gym:
     def construct_datasets(self, min_nodes: int, max_nodes: int, nb_train_graphs: int, nb_valid_graphs: int,
                            graphs_per_batch: int, nb_batches: int,
                            node_neighbors_aggregation: str = 'gcn',
-                           graph_type: str = 'powerlaw'):
+                           graph_type: str = 'powerlaw',
+                           graph_cache_dir: Optional[str] = None, graph_cache_factor: int = 5,
+                           graph_workers: Optional[int] = None):
         """
         @param min_nodes: minimum training scale (node set size)
         @param max_nodes: maximum training scale (node set size)
@@ -60,63 +78,70 @@ class Gym:
         @param nb_batches: number of batches to process per each training epoch
         @param node_neighbors_aggregation: {sum, mean, gcn (weighted sum)}
         @param graph_type: {powerlaw, erdos_renyi, powerlaw, small-world, barabasi_albert}
+        @param graph_cache_dir: if provided, generated graphs (with their betweenness) are stored there and reused
+        @param graph_cache_factor: how many times more graphs to keep in the cache than the ones used at once
+        @param graph_workers: number of processes generating the graphs (defaults to the number of CPUs left for the graph generation)
         """
+        if graph_cache_dir is not None and graph_cache_factor < 1:
+            raise ValueError(f'graph_cache_factor should be at least 1 when caching the graphs, got {graph_cache_factor}')
         self.aim_session.set_params(parse_params(locals()), name='dataset_params')
-        self.train_generator = DataGenerator(tag='Train', graph_type=graph_type, min_nodes=min_nodes, max_nodes=max_nodes, nb_graphs=nb_train_graphs, node_neighbors_aggregation=node_neighbors_aggregation, graphs_per_batch=graphs_per_batch, nb_batches=nb_batches, include_idx_map=False, random_samples=True, log_betweenness=True)
-        self.valid_generator = DataGenerator(tag='Valid', graph_type=graph_type, min_nodes=min_nodes, max_nodes=max_nodes, nb_graphs=nb_valid_graphs, node_neighbors_aggregation=node_neighbors_aggregation, graphs_per_batch=1, nb_batches=nb_valid_graphs, include_idx_map=True, random_samples=False, log_betweenness=False)
+        valid_graphs_per_batch = max(1, min(nb_valid_graphs, 16))
+        self.train_generator = DataGenerator(tag='Train', graph_type=graph_type, min_nodes=min_nodes, max_nodes=max_nodes, nb_graphs=nb_train_graphs, node_neighbors_aggregation=node_neighbors_aggregation, graphs_per_batch=graphs_per_batch, nb_batches=nb_batches, include_idx_map=False, random_samples=True, log_betweenness=True, cache_dir=graph_cache_dir, cache_size=graph_cache_factor * nb_train_graphs, graph_workers=graph_workers, worker_cpus=self.generation_cpus)
+        self.valid_generator = DataGenerator(tag='Valid', graph_type=graph_type, min_nodes=min_nodes, max_nodes=max_nodes, nb_graphs=nb_valid_graphs, node_neighbors_aggregation=node_neighbors_aggregation, graphs_per_batch=valid_graphs_per_batch, nb_batches=math.ceil(nb_valid_graphs / valid_graphs_per_batch), include_idx_map=True, random_samples=False, log_betweenness=False, cache_dir=graph_cache_dir, cache_size=graph_cache_factor * nb_valid_graphs, graph_workers=graph_workers, worker_cpus=self.generation_cpus)
+        self.train_dataset = self.train_generator.as_dataset()
         return self
 
     def construct_model(self, rnn_repetitions: int = 5, 
-                        optimizer='adam', aggregation: Optional[str] = 'max', combine: str = 'gru'):
+                        optimizer='adam', aggregation: Optional[str] = 'max', combine: str = 'gru',
+                        steps_per_execution: int = 10, mixed_precision: bool = False):
         """
         @param rnn_repetitions: number of RNN cycles
         @param optimizer: any tf.keras supported optimizer
-        @param aggregation: how to aggregate sequences after DrBCRNN {min, max, sum, mean, lstm}
+        @param aggregation: how to aggregate sequences after DrBCRNN {min, max, sum, mean, multi_attention, lstm, gru}
+               (min/max/sum/mean are single reductions, gru is a lighter alternative to lstm)
         @param combine: how to combine in each iteration in DrBCRNN {structure2vec, graphsage, gru}
+        @param steps_per_execution: number of batches run in a single tf.function call (batch-level callbacks are
+               called once per execution)
+        @param mixed_precision: compute in float16 keeping the variables and the output in float32
+               (compile wraps the optimizer in a LossScaleOptimizer under this policy)
         """
         self.aim_session.set_params(parse_params(locals()), name='model_params')
+        tf.keras.mixed_precision.set_global_policy('mixed_float16' if mixed_precision else 'float32')
         self.model = drbc_model(node_feature_dim=3, aux_feature_dim=4, rnn_repetitions=rnn_repetitions,
                                 aggregation=aggregation, combine=combine)
-        self.model.compile(optimizer=optimizer, loss=pairwise_ranking_crossentropy_loss)
+        self.model.compile(optimizer=optimizer, loss=pairwise_ranking_crossentropy_loss,
+                           steps_per_execution=steps_per_execution)
         self.model.summary()
         return self
 
-    def train(self, epochs: int, stop_patience: int = 5, lr_reduce_patience: int = 2):
+    def train(self, epochs: int, stop_patience: int = 5, lr_reduce_patience: int = 2,
+              data_update_frequency: int = 5, history_columns: Optional[List[str]] = None,
+              logger: str = 'tensorboard'):
         """
-        functional API with model.fit doesn't support sparse tensors with the current implementation =>
-        we write the training loop ourselves
+        @param epochs: maximum number of epochs to train for
+        @param stop_patience: number of epochs without improvement after which the training is stopped
+        @param lr_reduce_patience: number of epochs without improvement after which the learning rate is reduced
+        @param data_update_frequency: generate new train/valid graphs once per every `data_update_frequency` epochs
+        @param history_columns: metrics to keep in history.csv, e.g. [loss, val_kendal, val_top0_01] (all if None)
+        @param logger: where to log the metrics {tensorboard, aim, both}
         """
         self.aim_session.set_params(parse_params(locals()), name='train_params')
-        callbacks = CallbackList([
+        if logger not in {'tensorboard', 'aim', 'both'}:
+            raise ValueError(f'{logger} logger is not supported yet')
+        loggers = []
+        if logger in {'tensorboard', 'both'}:   loggers.append(TensorBoard(self.log_dir, profile_batch=0, update_freq='epoch'))
+        if logger in {'aim', 'both'}:           loggers.append(AimCallback(self.aim_session))
+
+        history = self.model.fit(self.train_dataset, epochs=epochs, verbose=1, callbacks=[
             EvaluateCallback(self.valid_generator, prepend_str='val_'),
-            TensorBoard(self.log_dir, profile_batch=0),
-            AimCallback(self.aim_session),
+            *loggers,
             ModelCheckpoint(self.model_save_path / 'best.h5py', monitor='val_kendal', save_best_only=True, verbose=1, mode='max'),
             EarlyStopping(monitor='val_kendal', patience=stop_patience, mode='max', restore_best_weights=True),
             ReduceLROnPlateau(monitor='val_kendal', patience=lr_reduce_patience, factor=0.7, mode='max'),
-            DataMonitor(self.train_generator, self.valid_generator, update_frequency=5, prefetch=1),
-        ],  add_history=True, add_progbar=True, verbose=1,
-            model=self.model,
-            epochs=epochs, steps=len(self.train_generator))
-
-        epoch_logs = {}
-        callbacks.on_train_begin()
-        for epoch in range(epochs):
-            callbacks.on_epoch_begin(epoch)
-            logs = {}
-            for batch, (x, y) in enumerate(self.train_generator):
-                callbacks.on_train_batch_begin(batch)
-                logs = self.model.train_on_batch(x, y, return_dict=True)
-                callbacks.on_train_batch_end(batch, logs)
-
-            epoch_logs = copy.copy(logs)
-            callbacks.on_epoch_end(epoch, logs=epoch_logs)
-            pd.DataFrame(self.model.history.history).to_csv(self.log_dir / 'history.csv', index=False)
-            if self.model.stop_training:
-                break
-
-        callbacks.on_train_end(copy.copy(epoch_logs))
-        return self.model.history.history
+            DataMonitor(self.train_generator, self.valid_generator, update_frequency=data_update_frequency, prefetch=1),
+            HistoryLogger(self.log_dir / 'history.csv', columns=history_columns),
+        ])
+        return history.history
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 from typing import Optional
 
 import tensorflow as tf
-from tensorflow.keras.layers import Input, Lambda, Concatenate, Dense, LeakyReLU, LSTM, Attention, MultiHeadAttention
+from tensorflow.keras.layers import Input, Lambda, Concatenate, Dense, LeakyReLU, LSTM, GRU, Attention, MultiHeadAttention
 from tensorflow.keras.models import Model
 
 from drbc.layers import DrBCRNN
@@ -13,7 +13,7 @@ def drbc_model(node_feature_dim: int = 3, aux_feature_dim: int = 4, rnn_repetiti
     @param node_feature_dim: initial node features, [Dc,1,1]
     @param aux_feature_dim: extra node features in the hidden layer in the decoder, [Dc,CI1,CI2,1]
     @param rnn_repetitions: how many loops are there in DrBCRNN
-    @param aggregation: how to aggregate sequences after DrBCRNN {min, max, sum, mean, multi_attention, lstm}
+    @param aggregation: how to aggregate sequences after DrBCRNN {min, max, sum, mean, multi_attention, lstm, gru}
     @param combine: how to combine in each iteration in DrBCRNN {structure2vec, graphsage, gru}
     @return: DrBC tf.keras model
     """
@@ -33,8 +33,9 @@ def drbc_model(node_feature_dim: int = 3, aux_feature_dim: int = 4, rnn_repetiti
     elif aggregation == 'multi_attention':
         n2n_features = MultiHeadAttention(num_heads=4, key_dim=128, dropout=0.2)(n2n_features, n2n_features)
         n2n_features = Lambda(lambda x: tf.reduce_sum(x, axis=-1), name='aggregate')(n2n_features)
-    elif aggregation == 'lstm':
-        n2n_features = LSTM(units=128, return_sequences=True)(n2n_features)
+    elif aggregation in {'lstm', 'gru'}:
+        rnn = LSTM if aggregation == 'lstm' else GRU
+        n2n_features = rnn(units=128, return_sequences=True)(n2n_features)
         n2n_features = Attention(use_scale=True)([n2n_features, n2n_features, n2n_features])
         n2n_features = Lambda(lambda x: tf.reduce_sum(x, axis=-1), name='aggregate')(n2n_features)
     n2n_features = Lambda(lambda x: tf.math.l2_normalize(x, axis=-1), name='normalize_n2n')(n2n_features)
@@ -42,6 +43,6 @@ def drbc_model(node_feature_dim: int = 3, aux_feature_dim: int = 4, rnn_repetiti
     all_features = Concatenate(axis=-1)([n2n_features, input_aux_features])
     top = Dense(64)(all_features)
     top = LeakyReLU()(top)
-    out = Dense(1)(top)
+    out = Dense(1, dtype='float32')(top)  # keep the output in float32 even under the mixed precision policy
 
     return Model(inputs=[input_node_features, input_aux_features, input_n2n], outputs=out, name='DrBC')
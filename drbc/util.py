@@ -1,10 +1,11 @@
 import os
 import random
 from threading import Thread
-from typing import Optional, Any
+from typing import Optional, Any, Sequence, Union
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.keras.callbacks import CSVLogger
 
 
 def fix_random_seed(seed=42):
@@ -28,3 +29,16 @@ class ThreadWithReturnValue(Thread):
     def join(self, timeout: Optional[float] = None) -> Any:
         super().join(timeout)
         return self._return
+
+
+class HistoryLogger(CSVLogger):
+    """ CSVLogger which appends only the tracked `columns` (all of them if not provided) as float32 values """
+    def __init__(self, filename, columns: Optional[Union[str, Sequence[str]]] = None,
+                 separator: str = ',', append: bool = False):
+        super().__init__(filename, separator=separator, append=append)
+        # fire passes a single column as a plain string => `in` would match substrings instead of the column names
+        self.columns = None if columns is None else {columns} if isinstance(columns, str) else set(columns)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = {k: np.float32(v) for k, v in (logs or {}).items() if self.columns is None or k in self.columns}
+        super().on_epoch_end(epoch, logs)
@@ -4,6 +4,7 @@
 from cython.operator import dereference as deref
 from libcpp.vector cimport vector
 from libcpp.memory cimport shared_ptr
+from libc.stdint cimport int64_t
 import numpy as np
 import tensorflow as tf
 
@@ -53,13 +54,11 @@ cdef class py_PrepareBatchGraph:
 
     @property
     def n2nsum_param(self):
-        matrix = deref(deref(self.inner_PrepareBatchGraph).n2nsum_param)
-        return self.ConvertSparseToTensor(matrix)
+        return self.ConvertSparseToTensor(deref(deref(self.inner_PrepareBatchGraph).n2nsum_param))
 
     @property
     def subgsum_param(self):
-        matrix = deref(deref(self.inner_PrepareBatchGraph).subgsum_param)
-        return self.ConvertSparseToTensor(matrix)
+        return self.ConvertSparseToTensor(deref(deref(self.inner_PrepareBatchGraph).subgsum_param))
 
     @property
     def neighbor_param(self):
@@ -93,33 +92,37 @@ cdef class py_PrepareBatchGraph:
 
     @property
     def pair_ids_src(self):
-        size_list = list(deref(self.inner_PrepareBatchGraph).size_list)
+        size_list = deref(self.inner_PrepareBatchGraph).size_list
         ids_src = []
         offset = 0
         for size in size_list:
-            ids_src += list(np.array(list(range(size))+list(np.random.choice(range(size), size=4*size, replace=True)))+offset)
+            ids_src.append(np.concatenate([np.arange(size), np.random.choice(size, size=4*size, replace=True)]) + offset)
             offset += size
-        return ids_src
+        return np.concatenate(ids_src)
 
     @property
     def pair_ids_tgt(self):
-        size_list = list(deref(self.inner_PrepareBatchGraph).size_list)
+        size_list = deref(self.inner_PrepareBatchGraph).size_list
         ids_tgt = []
         offset = 0
         for size in size_list:
-            ids_tgt += list(np.array(list(self.ahead_one(np.arange(size)))+list(np.random.choice(range(size), size=4*size, replace=True)))+offset)
+            ids_tgt.append(np.concatenate([self.ahead_one(np.arange(size)), np.random.choice(size, size=4*size, replace=True)]) + offset)
             offset += size
-        return ids_tgt
+        return np.concatenate(ids_tgt)
 
     @property
     def aggregatorID(self):
         return deref(self.inner_PrepareBatchGraph).aggregatorID
 
-    cdef ConvertSparseToTensor(self,sparseMatrix matrix):
-        rowIndex= matrix.rowIndex
-        colIndex= matrix.colIndex
-        data= matrix.value
-        rowNum= matrix.rowNum
-        colNum= matrix.colNum
-        indices = np.mat([rowIndex, colIndex]).transpose()
-        return tf.sparse.SparseTensor(indices, data, (rowNum,colNum))
+    cdef ConvertSparseToTensor(self, sparseMatrix& matrix):
+        # Fill the COO arrays in a typed loop instead of going through python lists of every index and value
+        cdef size_t i, nnz = matrix.value.size()
+        indices = np.empty((nnz, 2), dtype=np.int64)
+        values = np.empty(nnz, dtype=np.float32)
+        cdef int64_t[:, ::1] indices_view = indices
+        cdef float[::1] values_view = values
+        for i in range(nnz):
+            indices_view[i, 0] = matrix.rowIndex[i]
+            indices_view[i, 1] = matrix.colIndex[i]
+            values_view[i] = matrix.value[i]
+        return tf.sparse.SparseTensor(indices, values, (matrix.rowNum, matrix.colNum))
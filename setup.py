@@ -18,9 +18,8 @@ setup(
         'scipy>=1.5.4',
         'scikit-learn>=0.23.2',
         'numpy>=1.19.4',
-        'pandas>=1.1.5',
         'tqdm>=4.54.1',
-        'tensorflow>=2.3.0',
+        'tensorflow>=2.4.0',
         'fire>=0.3.1',
         'aim>=2.1.4',
     ],